@@ -1,28 +1,92 @@
-from .target import Target
-from .main import load_patch_file
-import argparse
+from .fitcache import FitCache
+from .scan import parse_scan
+from .target import (
+    MappedTarget, PlanningTarget, StreamingTarget, Target, parse_filesize
+)
+from .compiled import compile_patch, load_patch
+from .main import get_json, sanitize_defaults
+from .reclaim import load_tables
+import argparse, os, sys
 
 
 def do_patching(
     target, patch, output,
-    free_input, free_output,
-    defaults, roots, limit
+    free_input, free_output, fit_input, fit_output,
+    defaults, roots, limit, jobs,
+    fit_cache, fit_cache_size, mmap, stream, journal, binary_free,
+    scan_free, reclaim, plan
 ):
+    cache = None
+    if fit_cache is not None:
+        cache = FitCache(fit_cache, parse_filesize(fit_cache_size))
     print("Setting up patch target...")
-    patch_target = Target(target, free_input, limit)
+    target_type = Target
+    if mmap:
+        target_type = MappedTarget
+    elif stream:
+        target_type = StreamingTarget
+    elif plan is not None:
+        target_type = PlanningTarget
+    scans = [parse_scan(spec) for spec in scan_free or ()]
+    patch_target = target_type(target, free_input, limit, scans)
+    if reclaim:
+        print("Reclaiming replaced data...")
+        pointer_defaults = {} if defaults is None else sanitize_defaults(
+            get_json(defaults)
+        )
+        for name in reclaim:
+            patch_target.reclaim(load_tables(name, pointer_defaults))
     print("Reading patch...")
-    patch_map = load_patch_file(patch, defaults)
+    patch_map = load_patch(patch, defaults)
+    previous = None if fit_input is None else get_json(fit_input)
+    if plan is not None:
+        print("Planning patch...")
+        patch_target.write_patch(patch_map, roots, jobs, cache, previous)
+        print("Saving plan to {}...".format(plan))
+        patch_target.plan(plan)
+        print("Done.")
+        return
     print("Writing patch data...")
-    patch_target.write_patch(patch_map, roots)
+    patch_target.write_patch(patch_map, roots, jobs, cache, previous)
     print("Saving output files...")
     patch_target.save(
         target if output is None else output,
-        free_input if free_output is None else free_output
+        free_input if free_output is None else free_output,
+        fit_input if fit_output is None else fit_output,
+        journal, True if binary_free else None
     )
     print("Done.")
 
 
+def do_compiling(patch, defaults, output):
+    if output is None:
+        output = os.path.splitext(patch)[0] + '.bpatch'
+    print("Compiling {} to {}...".format(patch, output))
+    compile_patch(patch, defaults, output)
+    print("Done.")
+
+
+def compile_main(args):
+    parser = argparse.ArgumentParser(
+        prog='json_bpatch compile',
+        description='Compile a patch for faster loading.',
+        epilog="""The compiled patch can be used in place of the original
+        patch file (without specifying pointer defaults). It is recompiled
+        automatically when used, if the patch file, the defaults file or
+        any file included with "@" has changed since it was compiled.
+        By default, the output filename is the patch filename with the
+        extension replaced by `.bpatch`."""
+    )
+    parser.add_argument('patch', help='name of patch file')
+    parser.add_argument('-d', '--defaults', help='pointer defaults filename')
+    parser.add_argument('-o', '--output', help='name for compiled patch')
+    do_compiling(**vars(parser.parse_args(args)))
+
+
 def main():
+    if sys.argv[1:2] == ['compile']:
+        compile_main(sys.argv[2:])
+        return
     parser = argparse.ArgumentParser(
         prog='json_bpatch',
         description='Binary patcher using a JSON-based patch format.',
@@ -33,16 +97,87 @@ def main():
         The `limit` argument allows for specifying "virtual freespace" between
         the end of the file and the specified maximum filesize. It may be
         specified as a raw number of bytes, or with a case-insensitive
-        size postfix (like the `du` linux command)."""
+        size postfix (like the `du` linux command).
+        If fitting requires a full search, the `jobs` argument allows
+        running several differently-ordered searches in parallel; the
+        first to finish is used.
+        With a `fit-cache` directory, fitting results are saved there and
+        reused when the same patch items are fitted into the same freespace
+        again; the least recently used results are discarded once the
+        directory holds more than `fit-cache-size` (default 16m).
+        A fit record (written with `fit-output`) describes where each patch
+        item was placed; when one is read with `fit-input`, items that are
+        unchanged since then are kept in the same places if possible. As
+        with the freespace file, the record is written back to the input
+        file unless an output file is specified.
+        With `mmap`, the target file is not read into memory; the patch data
+        is written through a memory map instead, which is much more
+        efficient for large files. With `stream`, the target file is not
+        read into memory either; the output is written in one sequential
+        pass, copying the target and splicing in the patch data.
+        When the output is written over the target file, only the changed
+        parts are written. With `journal`, their original contents are
+        saved beforehand, so that an interrupted save is undone the next
+        time the file is patched.
+        Each `scan-free` option marks every run of at least MINLEN copies
+        of BYTE in the target (optionally, only within START-END) as free,
+        in addition to any freespace file.
+        Each `reclaim` file describes tables of pointers in the target; the
+        data they point at is also marked as free (see the README).
+        With `plan`, nothing is patched or saved: the target is only
+        checked for its size, and the fit record and the freespace that
+        would remain are written to the plan file as JSON."""
     )
     parser.add_argument('target', help='name of file to patch')
     parser.add_argument('patch', help='name of patch file')
     parser.add_argument('-o', '--output', help='name to use for patched result')
     parser.add_argument('-f', '--free-input', help='freespace file to read')
     parser.add_argument('-F', '--free-output', help='freespace file to write')
+    parser.add_argument(
+        '-B', '--binary-free', action='store_true',
+        help='write freespace file in binary format'
+    )
+    parser.add_argument(
+        '-s', '--scan-free', action='append',
+        metavar='BYTE:MINLEN[:START-END]',
+        help='treat runs of a filler byte in the target as free'
+    )
+    parser.add_argument(
+        '-R', '--reclaim', action='append', metavar='FILE',
+        help='pointer tables whose referenced data becomes free'
+    )
+    parser.add_argument('-m', '--fit-input', help='fit record file to read')
+    parser.add_argument('-M', '--fit-output', help='fit record file to write')
     parser.add_argument('-d', '--defaults', help='pointer defaults filename')
     parser.add_argument('-r', '--roots', nargs='+', help='roots for patching'),
     parser.add_argument('-l', '--limit', help='maximum filesize when appending')
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=1,
+        help='number of parallel fitting searches'
+    )
+    parser.add_argument(
+        '-c', '--fit-cache', help='directory for caching fitting results'
+    )
+    parser.add_argument(
+        '--fit-cache-size', default='16m', help='maximum size of fit cache'
+    )
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        '--mmap', action='store_true',
+        help='patch through a memory map, without reading the whole target'
+    )
+    mode.add_argument(
+        '--stream', action='store_true',
+        help='write output sequentially, without reading the whole target'
+    )
+    mode.add_argument(
+        '--plan', metavar='FILE',
+        help='only fit the patch, and write the result to FILE as JSON'
+    )
+    parser.add_argument(
+        '--journal', action='store_true',
+        help='journal in-place saves so they can be recovered'
+    )
     do_patching(**vars(parser.parse_args()))
 
 
@@ -0,0 +1,166 @@
+"""Compiled patch files: a patch (along with its pointer defaults) in a
+binary form that can be loaded without parsing or decoding anything up
+front.
+
+The file consists of `MAGIC`, the length of the index as an 8-byte
+little-endian number, the index (in `marshal` format), and then the raw
+data for every Datum, back to back. The index records the source files
+the patch was compiled from (so that it can be recompiled when they
+change), and each item's components, as tuples:
+    (DATA, start, stop) -> a Datum, at [start:stop] in the raw data
+    (FILE, filename) -> a FileDatum
+    (POINTER, referent, offset, size, align, stride, signed, bigendian)"""
+
+
+from collections.abc import Mapping
+from mmap import mmap, ACCESS_READ
+import marshal, os, struct
+from .main import (
+    get_json, load_patch_file, make_datum, pointer_params, sanitize_defaults
+)
+from .patch import Datum, FileDatum, Patch, Pointer
+
+
+MAGIC = b'JBPATCH\x01'
+DATA, FILE, POINTER = range(3)
+
+
+def _source_info(filename):
+    """(absolute path, modification time, size) for a source file, used to
+    tell whether it has changed."""
+    info = os.stat(filename)
+    return os.path.abspath(filename), info.st_mtime_ns, info.st_size
+
+
+def compile_patch(patch_name, defaults_name, output_name):
+    """Compile the named patch file (using the named pointer defaults file,
+    if any) into the named output file."""
+    parsed = get_json(patch_name)
+    if not isinstance(parsed, dict):
+        raise ValueError('data must be a JSON object with Patches as values')
+    defaults = sanitize_defaults(
+        {} if defaults_name is None else get_json(defaults_name)
+    )
+    sources = [_source_info(patch_name)]
+    if defaults_name is not None:
+        sources.append(_source_info(defaults_name))
+    blob, size, items = [], 0, {}
+    for name, patch in parsed.items():
+        if not isinstance(patch, list):
+            raise ValueError('Patch must be a JSON array of Patch items')
+        components = []
+        for component in patch:
+            if isinstance(component, dict):
+                components.append(
+                    (POINTER,) + pointer_params(defaults, component)
+                )
+            elif not isinstance(component, str):
+                raise ValueError('Patch item must be a Datum or a Pointer')
+            elif component.startswith('@'):
+                source = _source_info(component[1:])
+                sources.append(source)
+                components.append((FILE, source[0]))
+            else:
+                data = make_datum(component).data(None)
+                blob.append(data)
+                components.append((DATA, size, size + len(data)))
+                size += len(data)
+        items[name] = tuple(components)
+    index = marshal.dumps({
+        'defaults': None if defaults_name is None
+        else os.path.abspath(defaults_name),
+        'sources': sources,
+        'items': items
+    })
+    # Replacing the output atomically means that it's safe to recompile a
+    # patch while it's in use.
+    temp = '{}.{}.tmp'.format(output_name, os.getpid())
+    with open(temp, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(index)))
+        f.write(index)
+        for data in blob:
+            f.write(data)
+    os.replace(temp, output_name)
+
+
+def is_compiled(filename):
+    with open(filename, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+class CompiledPatchMap(Mapping):
+    """As `main.PatchMap`, but for a compiled patch file, which is memory
+    mapped so that only the data for the Patches looked up is read."""
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            self._view = mmap(f.fileno(), 0, access=ACCESS_READ)
+        if self._view[:len(MAGIC)] != MAGIC:
+            raise ValueError('{} is not a compiled patch'.format(filename))
+        start = len(MAGIC) + 8
+        length, = struct.unpack_from('<Q', self._view, len(MAGIC))
+        index = marshal.loads(self._view[start:start + length])
+        self.defaults = index['defaults']
+        self.sources = index['sources']
+        self._items = index['items']
+        self._data_start = start + length
+        self._patches = {}
+
+
+    def is_stale(self):
+        """Whether any of the files the patch was compiled from have
+        changed since then."""
+        for filename, mtime, size in self.sources:
+            try:
+                if _source_info(filename) != (filename, mtime, size):
+                    return True
+            except OSError:
+                return True
+        return False
+
+
+    def _component(self, component):
+        kind = component[0]
+        if kind == DATA:
+            start, stop = component[1:]
+            offset = self._data_start
+            return Datum(self._view[offset + start:offset + stop])
+        if kind == FILE:
+            return FileDatum(component[1])
+        return Pointer(*component[1:])
+
+
+    def __getitem__(self, name):
+        try:
+            return self._patches[name]
+        except KeyError:
+            pass
+        patch = Patch([self._component(c) for c in self._items[name]])
+        self._patches[name] = patch
+        return patch
+
+
+    def __iter__(self):
+        return iter(self._items)
+
+
+    def __len__(self):
+        return len(self._items)
+
+
+def load_patch(patch_name, defaults_name):
+    """Load a patch file, which may be compiled (or otherwise, in the usual
+    JSON format, using the named pointer defaults file, if any). A compiled
+    patch is recompiled first if it's out of date."""
+    if not is_compiled(patch_name):
+        return load_patch_file(patch_name, defaults_name)
+    result = CompiledPatchMap(patch_name)
+    if defaults_name is not None and (
+        os.path.abspath(defaults_name) != result.defaults
+    ):
+        raise ValueError('patch was compiled with different defaults')
+    if result.is_stale():
+        print("Recompiling {}...".format(patch_name))
+        compile_patch(result.sources[0][0], result.defaults, patch_name)
+        result = CompiledPatchMap(patch_name)
+    return result
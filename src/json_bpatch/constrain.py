@@ -1,10 +1,23 @@
-def gcd(x, y):
-    """Iterative implementation of Euclid's algorithm."""
-    if x < y:
-        x, y = y, x
-    while x > y and y != 0:
-        x, y = y, x % y
-    return x
+from bisect import bisect_right
+from collections import Counter
+from functools import lru_cache
+from hashlib import sha1
+from heapq import heapify, heappop, heappush
+from multiprocessing import Pipe, Process
+from multiprocessing.connection import wait
+from random import Random
+
+
+def extended_gcd(x, y):
+    """Iterative extended Euclidean algorithm. Returns (g, a, b) such that
+    g is the gcd of x and y, and a*x + b*y == g."""
+    a0, a1, b0, b1 = 1, 0, 0, 1
+    while y != 0:
+        q, r = divmod(x, y)
+        x, y = y, r
+        a0, a1 = a1, a0 - q * a1
+        b0, b1 = b1, b0 - q * b1
+    return x, a0, b0
 
 
 def range_intersect(x, y):
@@ -19,21 +32,46 @@ def range_intersect(x, y):
 
     stop = min(x.stop, y.stop)
     # Check that the start points are congruent modulo the gcd of strides.
-    stride_gcd = gcd(x.step, y.step)
+    stride_gcd, inverse, _ = extended_gcd(x.step, y.step)
     step = x.step * y.step // stride_gcd # lcm
     start = stop # default result: empty range
-    if x.start % stride_gcd == y.start % stride_gcd:
-        # The sequences line up eventually; check values from y until we find
-        # one that's in x, or exceed the stopping point.
-        # There doesn't seem to be a neater approach; in the worst case, this
-        # is apparently equivalent to decrypting RSA.
-        try:
-            start = next(v for v in range(y.start, stop, y.step) if v in x)
-        except StopIteration:
-            pass # couldn't find a start point.
+    offset = y.start - x.start
+    if offset % stride_gcd == 0:
+        # The sequences line up; solve for the first value from x that is
+        # also in y (Chinese remainder theorem). Since `inverse` * x.step is
+        # congruent to the gcd modulo y.step, stepping `offset // gcd` times
+        # that many x-steps lands on a value congruent to y.start.
+        common = x.start + x.step * (
+            (offset // stride_gcd * inverse) % (y.step // stride_gcd)
+        )
+        # `common` is the first common value that is >= x.start; advance to
+        # the first one that is also >= y.start.
+        if common < y.start:
+            common += -((common - y.start) // step) * step
+        start = min(common, stop)
     return range(start, stop, step)
 
 
+def intersect_gamuts(gamuts):
+    """Intersect all of the `gamuts` (ranges), in a single pass.
+    Returns `None` (meaning "no restriction") if there are none.
+    Duplicate gamuts (as from identically configured pointers) are only
+    considered once."""
+    result = None
+    for gamut in set(gamuts):
+        result = range_intersect(result, gamut)
+        if not result:
+            break # Can't get any emptier.
+    return result
+
+
+def gamut_data(gamut):
+    """JSON-compatible representation of a gamut."""
+    if gamut is None:
+        return None
+    return [gamut.start, gamut.stop, gamut.step]
+
+
 def make_gamut_map(patch_map, roots):
     """Produce a map from patch items that will be included in patching,
     to the pointer constraints placed upon their patch locations.
@@ -44,45 +82,910 @@ def make_gamut_map(patch_map, roots):
     processed = set()
     to_process = set(roots)
     # Ensure that the roots appear in the result.
-    result = {r: None for r in to_process}
-    # Iteratively apply constraints from "discovered" pointers.
+    constraints = {r: [] for r in to_process}
+    # Iteratively collect constraints from "discovered" pointers.
     while to_process:
         p = to_process.pop()
-        patch_map[p].constrain(result, processed, to_process)
+        patch_map[p].constrain(constraints, processed, to_process)
         processed.add(p)
-    return result
+    # Apply all constraints for each item at once.
+    return {
+        name: intersect_gamuts(gamuts)
+        for name, gamuts in constraints.items()
+    }
 
 
-def make_fit_map_rec(patch_map, gamut_map, freespace, fits, unfitted):
-    if not unfitted:
-        return fits # reached end of recursion
+def _measure(key, start, stop):
+    """For items with the given (size, gamut) `key`, the number of places
+    they could be written within the free chunk [start, stop), and the
+    number of bytes in the chunk that such placements could cover.
+    Since the items are all the same size, and can't overlap, they can only
+    cover a whole multiple of that size."""
+    size, gamut = key
+    if stop - start < size:
+        return 0, 0
+    if gamut is None:
+        span = stop - start
+        return span - size + 1, span - span % size
+    options = range_intersect(range(start, stop - size + 1), gamut)
+    if not options:
+        return 0, 0
+    if options.step >= size:
+        return len(options), len(options) * size # Placements can't overlap.
+    span = options[-1] + size - options[0]
+    return len(options), span - span % size
 
-    # Recompute candidates for each unfitted item, and select the
-    # most constrained.
-    candidate_mapping = {
-        name: freespace.candidates(len(patch_map[name]), gamut_map[name])
-        for name in unfitted
-    }
-    name = min(unfitted, key=lambda n: (len(candidate_mapping[n]), n))
-
-    for candidate in candidate_mapping[name]:
-        recurse = make_fit_map_rec(
-            patch_map,
-            gamut_map,
-            freespace.excluding(candidate, len(patch_map[name])),
-            fits + ((name, candidate),),
-            tuple(x for x in unfitted if x != name)
+
+def empty_location(gamut, extent=None):
+    """Location for a zero-length patch item, subject to its `gamut`: the
+    first one that is within the file, which may extend up to `extent`
+    (if specified). Returns None if there isn't one."""
+    if gamut is None:
+        return 0
+    stop = gamut.stop if extent is None else min(gamut.stop, extent + 1)
+    options = range_intersect(gamut, range(0, max(stop, 0)))
+    return options[0] if options else None
+
+
+@lru_cache(maxsize=1 << 16)
+def _zobrist(value):
+    """Pseudo-random 128-bit key for `value`, for incremental hashing of the
+    search state by XOR. The key is a digest of the value's `repr`, so that
+    collisions (which could wrongly prune a branch) are not a concern."""
+    digest = sha1(repr(value).encode('utf-8')).digest()
+    return int.from_bytes(digest[:16], 'little')
+
+
+# The selection heap is rebuilt once it has this many entries per key.
+HEAP_SLACK = 4
+# Forget all recorded nogoods once there are this many. Each one is a
+# 128-bit integer, so a full set takes around 80 MB.
+MAX_NOGOODS = 1 << 20
+
+
+class _Live:
+    """Container of the indices of live regions, given a list of counts."""
+    def __init__(self, counts):
+        self._counts = counts
+
+
+    def __contains__(self, region):
+        return self._counts[region] > 0
+
+
+class Fitter:
+    """Backtracking search for locations to write a set of patch items.
+
+    The search is driven by an explicit stack rather than recursion, so the
+    number of items is not limited by the interpreter's recursion limit.
+    The assignment is kept in a single dict, and trial placements are
+    undone through the freespace journal.
+
+    At each step, the item with the fewest candidate locations is placed
+    next. Rather than recomputing every item's candidates at each step,
+    the candidate count is maintained incrementally: the freespace chunks
+    at the start of the search ("regions") are indexed by which items could
+    go there, and a placement only updates the counts for items that could
+    use the region it was made in. Items with the same size and gamut have
+    the same candidates, so they share a single count.
+
+    When an item runs out of candidates, the search backjumps directly to
+    the most recent placement that could have caused it (one in a region
+    the failed item could use, or one blamed for a failure further down),
+    rather than retrying placements that can't make a difference. Each
+    failed state (the set of unfitted items, plus the freespace in regions
+    that any of them could use) is also recorded as a "nogood", so that
+    reaching the same state by another route fails immediately.
+
+    Branches are also pruned by a capacity bound: the unfitted items must
+    not need more bytes than are free in the regions they could use, and
+    the unfitted items with each (size, gamut) key must not need more bytes
+    than could be covered by placements for that key.
+
+    Items with the same key are interchangeable as far as fitting is
+    concerned, so they are always placed in name order, each one after the
+    previous. That way, each set of locations for them is only tried once,
+    rather than once per permutation.
+
+    If a `seed` is specified, the chunks are tried in a pseudo-random order
+    (determined by the seed) for each item, instead of ascending order.
+    This gives differently-ordered searches that can be run in parallel."""
+    def __init__(self, sizes, gamut_map, freespace, stats=None, seed=None):
+        self.stats = Counter() if stats is None else stats
+        self._shuffle = None if seed is None else Random(seed)
+        self._free = freespace.copy() # don't disturb the caller's copy.
+        self._sizes = sizes
+        self._fits = {}
+        self._key_of = {}
+        # key -> sorted names of items with that key. The unfitted items
+        # are always a suffix of the list, starting at `self._next[key]`,
+        # since the first unfitted one is always chosen and backtracking
+        # happens in reverse order.
+        self._members = {}
+        self._next = {}
+        self._counts = {}
+        # key -> number of free bytes that items with that key could cover.
+        self._reach = {}
+        regions = freespace.data
+        self._regions = regions
+        self._region_starts = [start for start, stop in regions]
+        self._keys_by_region = [set() for _ in regions]
+        self._regions_of = {}
+        # Heap of (count, name, key) for selecting the most constrained item;
+        # outdated entries are skipped when popped.
+        self._heap = []
+        self._impossible = False
+        for name in sorted(sizes):
+            key = (sizes[name], gamut_map[name])
+            if key[0] == 0:
+                # Zero-length items can go anywhere, and take up no space.
+                where = empty_location(key[1])
+                if where is None:
+                    self._impossible = True
+                else:
+                    self._fits[name] = where
+                continue
+            self._key_of[name] = key
+            self._members.setdefault(key, []).append(name)
+        for key in self._members:
+            self._next[key] = 0
+            self._counts[key] = 0
+            self._reach[key] = 0
+            self._regions_of[key] = set()
+            for i, count, reach in self._measure_regions(key):
+                self._counts[key] += count
+                self._reach[key] += reach
+                self._keys_by_region[i].add(key)
+                self._regions_of[key].add(i)
+            self._push(key)
+        # Bookkeeping for backjumping: the region of each placement.
+        self._region_of_fit = {}
+        # Bookkeeping for nogoods. The state is hashed incrementally;
+        # each region's hash covers the free chunks within it, and only
+        # "live" regions (usable by some unfitted item) count towards
+        # `_free_hash`.
+        self._nogoods = set()
+        self._region_hashes = [_zobrist(tuple(r)) for r in regions]
+        self._live = [len(keys) for keys in self._keys_by_region]
+        self._free_hash = 0
+        for h, live in zip(self._region_hashes, self._live):
+            if live:
+                self._free_hash ^= h
+        self._unfitted_hash = 0
+        for name in self._key_of:
+            self._unfitted_hash ^= _zobrist(name)
+        # Covers the location of the last placed item of each key that
+        # still has unfitted items, since that restricts where they can go.
+        self._order_hash = 0
+        # Bookkeeping for the capacity bound.
+        self._region_free = [stop - start for start, stop in regions]
+        self._live_bytes = sum(
+            free for free, live in zip(self._region_free, self._live) if live
         )
-        if recurse is not None: # This candidate value works.
-            return recurse
-    # Found no solution; propagate None up the recursion.
+        self._unfitted_bytes = sum(sizes[name] for name in self._key_of)
 
 
-def make_fit_map(patch_map, roots, freespace):
-    gamut_map = make_gamut_map(patch_map, roots)
-    fits = make_fit_map_rec(
-        patch_map, gamut_map, freespace, (), gamut_map.keys()
+    def _measure_regions(self, key):
+        """Generate (region index, count, reach) for each region that items
+        with the given `key` could use, as per `_measure`. The regions are
+        measured all at once if possible (see `Freespace.candidate_arrays`).
+        Only valid before anything is placed."""
+        arrays = self._free.candidate_arrays(*key)
+        if arrays is None:
+            for i, (start, stop) in enumerate(self._regions):
+                count, reach = _measure(key, start, stop)
+                if count:
+                    yield i, count, reach
+            return
+        size = key[0]
+        firsts, stops, counts, step = arrays
+        if step >= size:
+            reaches = counts * size # Placements can't overlap.
+        else:
+            spans = (counts - 1) * step + size
+            reaches = spans - spans % size
+        usable = counts.nonzero()[0]
+        yield from zip(
+            usable.tolist(), counts[usable].tolist(), reaches[usable].tolist()
+        )
+
+
+    def _push(self, key):
+        members, i = self._members[key], self._next[key]
+        if i < len(members):
+            heappush(self._heap, (self._counts[key], members[i], key))
+        if len(self._heap) > HEAP_SLACK * (len(self._members) + 1):
+            self._rebuild_heap()
+
+
+    def _rebuild_heap(self):
+        """Replace the heap with just the current entry for each key that
+        has unfitted items, so that outdated entries don't pile up."""
+        self._heap = [
+            (self._counts[key], members[self._next[key]], key)
+            for key, members in self._members.items()
+            if self._next[key] < len(members)
+        ]
+        heapify(self._heap)
+
+
+    def _select(self):
+        """Choose the unfitted item with the fewest candidate locations
+        (ties broken by name), or return None if everything is fitted."""
+        heap = self._heap
+        while heap:
+            count, name, key = heap[0]
+            members, i = self._members[key], self._next[key]
+            if (
+                count == self._counts[key]
+                and i < len(members) and members[i] == name
+            ):
+                return name
+            heappop(heap) # Outdated entry.
+        return None
+
+
+    def _toggle_live(self, key, change):
+        """Update region liveness when `key` runs out of unfitted items
+        (`change` == -1) or gets one back (`change` == 1)."""
+        for region in self._regions_of[key]:
+            if self._live[region] == 0 or self._live[region] + change == 0:
+                self._free_hash ^= self._region_hashes[region]
+                self._live_bytes += change * self._region_free[region]
+            self._live[region] += change
+
+
+    def _take(self, name):
+        key = self._key_of[name]
+        self._next[key] += 1
+        self._unfitted_hash ^= _zobrist(name)
+        self._unfitted_bytes -= key[0]
+        if self._next[key] == len(self._members[key]):
+            self._toggle_live(key, -1)
+        self._push(key)
+
+
+    def _release(self, name):
+        key = self._key_of[name]
+        if self._next[key] == len(self._members[key]):
+            self._toggle_live(key, 1)
+        self._next[key] -= 1
+        self._unfitted_hash ^= _zobrist(name)
+        self._unfitted_bytes += key[0]
+        self._push(key)
+
+
+    def _predecessor(self, key):
+        """The item of the given `key` that must be placed before the one
+        most recently taken, or None if there isn't one."""
+        i = self._next[key] - 2
+        return self._members[key][i] if i >= 0 else None
+
+
+    def _lowest(self, key):
+        """The first location allowed for the item of the given `key` that
+        was most recently taken, given the order for interchangeable items."""
+        previous = self._predecessor(key)
+        return None if previous is None else self._fits[previous] + key[0]
+
+
+    def _adjust(self, key, delta, reach_delta):
+        self._counts[key] += delta
+        self._reach[key] += reach_delta
+        self._push(key)
+
+
+    def _short_of_space(self, keys):
+        """Check the capacity bound, for each of the `keys` and for the
+        unfitted items as a whole. Returns the keys that fail their
+        individual bound, or None if everything passes."""
+        short = [
+            key for key in keys
+            if (len(self._members[key]) - self._next[key]) * key[0]
+            > self._reach[key]
+        ]
+        if short:
+            return short
+        if self._unfitted_bytes > self._live_bytes:
+            return []
+        return None
+
+
+    def _place(self, name, where):
+        """Mark the item `name` as written at `where`, and return the
+        information needed to undo that."""
+        size = self._sizes[name]
+        start, stop = self._free.chunk_at(where)
+        region = bisect_right(self._region_starts, where) - 1
+        deltas = []
+        for key in self._keys_by_region[region]:
+            before, reach_before = _measure(key, start, stop)
+            left, reach_left = _measure(key, start, where)
+            right, reach_right = _measure(key, where + size, stop)
+            delta = left + right - before
+            reach_delta = reach_left + reach_right - reach_before
+            if delta or reach_delta:
+                self._adjust(key, delta, reach_delta)
+                deltas.append((key, delta, reach_delta))
+        # Update the state hash for the split chunk.
+        change = _zobrist((start, stop))
+        if start < where:
+            change ^= _zobrist((start, where))
+        if where + size < stop:
+            change ^= _zobrist((where + size, stop))
+        self._rehash_region(region, change)
+        self._resize_region(region, -size)
+        # Update the ordering constraint for the rest of the key.
+        key = self._key_of[name]
+        previous = self._predecessor(key)
+        order_change = 0
+        if previous is not None:
+            order_change ^= _zobrist((key, self._fits[previous]))
+        if self._next[key] < len(self._members[key]):
+            order_change ^= _zobrist((key, where))
+        self._order_hash ^= order_change
+        marker = self._free.checkpoint()
+        self._free.remove(where, size)
+        self._fits[name] = where
+        self._region_of_fit[name] = region
+        self.stats['placements'] += 1
+        return marker, deltas, region, change, order_change
+
+
+    def _unplace(self, name, undo):
+        marker, deltas, region, change, order_change = undo
+        self._order_hash ^= order_change
+        self._free.rollback(marker)
+        for key, delta, reach_delta in deltas:
+            self._adjust(key, -delta, -reach_delta)
+        self._rehash_region(region, change)
+        self._resize_region(region, self._sizes[name])
+        del self._fits[name]
+        del self._region_of_fit[name]
+        self.stats['backtracks'] += 1
+
+
+    def _rehash_region(self, region, change):
+        self._region_hashes[region] ^= change
+        if self._live[region]:
+            self._free_hash ^= change
+
+
+    def _resize_region(self, region, change):
+        self._region_free[region] += change
+        if self._live[region]:
+            self._live_bytes += change
+
+
+    def _state(self):
+        # The parts hash different kinds of values (names, chunks and
+        # placements), so they can be combined into a single key.
+        return self._unfitted_hash ^ self._free_hash ^ self._order_hash
+
+
+    def _record_nogood(self):
+        if len(self._nogoods) >= MAX_NOGOODS:
+            self._nogoods.clear()
+        self._nogoods.add(self._state())
+        self.stats['nogoods'] += 1
+
+
+    def has_capacity(self):
+        """Check the capacity bound for the unfitted items as a whole and
+        for each key. If this is False, fitting is certainly impossible;
+        if it is True, fitting may still fail."""
+        return self._short_of_space(self._members) is None
+
+
+    def _placed_in(self, regions, stack):
+        """Names of the items placed in any of the `regions` (a container of
+        region indices), except the one on top of the `stack`."""
+        return [
+            f[0] for f in stack[:-1] if self._region_of_fit[f[0]] in regions
+        ]
+
+
+    def _explain(self, frame, stack):
+        """Names of the placed items that could have caused the item in the
+        top `frame` of the `stack` to run out of candidates."""
+        conflicts = frame[3]
+        key = self._key_of[frame[0]]
+        conflicts.update(self._placed_in(self._regions_of[key], stack))
+        previous = self._predecessor(key)
+        if previous is not None:
+            conflicts.add(previous)
+        return conflicts
+
+
+    def _ordering_items(self):
+        """Names of the placed items that restrict where the unfitted
+        items of their key can go."""
+        return [
+            members[i - 1] for key, members in self._members.items()
+            for i in (self._next[key],) if 0 < i < len(members)
+        ]
+
+
+    def _explain_shortage(self, short, stack):
+        """Names of the placed items that could have caused the capacity
+        bound to fail for the `short` keys (or, if there are none, for the
+        unfitted items as a whole). These are the placements in the regions
+        those items could use; moving any other item could only take away
+        more space, which can't help."""
+        if not short:
+            return self._placed_in(_Live(self._live), stack)
+        regions = set()
+        for key in short:
+            regions.update(self._regions_of[key])
+        return self._placed_in(regions, stack)
+
+
+    def preplaced(self):
+        """Locations for the items that don't need searching (zero-length
+        items), or None if one of them can't be placed at all."""
+        if self._impossible:
+            return None
+        return dict(self._fits)
+
+
+    def components(self):
+        """Split the items to search for into independent groups, such that
+        no two groups could use the same region. Returns a list of (names,
+        Freespace) pairs, where the Freespace has only the regions that
+        group could use."""
+        # Imported here, since the freespace module depends on this one.
+        from .freespace import Freespace
+        # Union-find over keys, joining those that share a region.
+        parent = {key: key for key in self._members}
+        def root(key):
+            while parent[key] != key:
+                parent[key] = parent[parent[key]]
+                key = parent[key]
+            return key
+        for keys in self._keys_by_region:
+            keys = list(keys)
+            for key in keys[1:]:
+                parent[root(key)] = root(keys[0])
+        groups = {}
+        for key in self._members:
+            groups.setdefault(root(key), []).append(key)
+        result = []
+        for keys in groups.values():
+            names = sorted(name for key in keys for name in self._members[key])
+            free = Freespace()
+            for region in sorted(set().union(
+                *(self._regions_of[key] for key in keys)
+            )):
+                start, stop = self._regions[region]
+                free.add(start, stop - start)
+            result.append((names, free))
+        result.sort(key=lambda group: group[0])
+        return result
+
+
+    def run_greedy(self):
+        """Try placing each item, most constrained (then largest) first, in
+        the smallest chunk that can hold it, without backtracking. Returns a
+        dict of (name) -> (location) on success, or None on failure; either
+        way, the Fitter is left ready to `run`."""
+        if self._impossible:
+            return None
+        order = sorted(self._key_of, key=lambda name: (
+            self._counts[self._key_of[name]], -self._sizes[name], name
+        ))
+        fits = dict(self._fits)
+        marker = self._free.checkpoint()
+        for name in order:
+            size, gamut = self._key_of[name]
+            where = self._free.best_fit(size, gamut)
+            if where is None:
+                fits = None
+                break
+            self._free.remove(where, size)
+            fits[name] = where
+        self._free.rollback(marker)
+        return fits
+
+
+    def run(self):
+        """Perform the search. Returns a dict of (name) -> (location),
+        or None if there is no way to fit everything."""
+        if self._impossible:
+            return None
+        if not self.has_capacity():
+            self.stats['capacity_prunes'] += 1
+            self.stats['no_capacity'] += 1
+            return None
+        # Each frame is [name, iterator over candidates, undo information,
+        # names blamed for failures of this item's candidates so far].
+        stack = []
+        while True:
+            name = self._select()
+            if name is None:
+                return self._fits
+            self._take(name)
+            key = self._key_of[name]
+            candidates = self._free.iter_candidates(
+                key[0], key[1], self._lowest(key), self._shuffle
+            )
+            stack.append([name, candidates, None, set()])
+            # Place the item on top of the stack at its next candidate
+            # location, unwinding exhausted frames as needed.
+            while stack:
+                frame = stack[-1]
+                name, candidates, undo, _ = frame
+                if undo is not None:
+                    self._unplace(name, undo)
+                    frame[2] = None
+                candidate = next(candidates, None)
+                if candidate is not None:
+                    frame[2] = self._place(name, candidate)
+                    short = self._short_of_space(
+                        key for key, _, reach_delta in frame[2][1]
+                        if reach_delta
+                    )
+                    if short is not None:
+                        self.stats['capacity_prunes'] += 1
+                        frame[3].update(self._explain_shortage(short, stack))
+                        continue
+                    if self._state() not in self._nogoods:
+                        break
+                    # Known to fail from here. Only the placements in live
+                    # regions, and the ones that restrict where the rest of
+                    # their key can go, are part of the state; so only they
+                    # are blamed (as for a failed capacity bound).
+                    self.stats['nogood_hits'] += 1
+                    frame[3].update(self._explain_shortage([], stack))
+                    frame[3].update(self._ordering_items())
+                    frame[3].discard(name)
+                    continue
+                # This item can't be placed; jump back to the most recent
+                # placement that could be responsible.
+                conflicts = self._explain(frame, stack)
+                stack.pop()
+                self._release(name)
+                self._record_nogood()
+                while stack and stack[-1][0] not in conflicts:
+                    skipped = stack.pop()
+                    self._unplace(skipped[0], skipped[2])
+                    self._release(skipped[0])
+                    self._record_nogood()
+                    self.stats['backjumps'] += 1
+                if stack:
+                    stack[-1][3].update(conflicts)
+                    stack[-1][3].discard(stack[-1][0])
+            else:
+                return None # Exhausted every option for the first item.
+
+
+def is_valid_fit(sizes, gamut_map, freespace, fits):
+    """Check that `fits` places every item named in `sizes` within the
+    `freespace` and its gamut, without overlapping any other item."""
+    if fits.keys() != sizes.keys():
+        return False
+    end = None
+    for where, name in sorted((where, name) for name, where in fits.items()):
+        size, gamut = sizes[name], gamut_map[name]
+        if gamut is not None and where not in gamut:
+            return False
+        if size == 0:
+            continue # Takes up no space.
+        chunk = freespace.chunk_at(where)
+        if chunk is None or where + size > chunk[1]:
+            return False
+        if end is not None and where < end:
+            return False
+        end = where + size
+    return True
+
+
+def _worker(connection, function, args):
+    connection.send(function(*args))
+    connection.close()
+
+
+def _in_processes(function, tasks, jobs):
+    """Call `function(*args)` for each `args` tuple in `tasks`, in up to
+    `jobs` worker processes at once. Generates (index into `tasks`, result)
+    pairs in the order the calls finish. Any workers still running when the
+    generator is closed are terminated.
+    Each worker reports back through its own pipe, so terminating one
+    can't interfere with the results from the others."""
+    pending = list(enumerate(tasks))[::-1]
+    running = {} # receiving end of pipe -> (index, process)
+    try:
+        while pending or running:
+            while pending and len(running) < jobs:
+                index, args = pending.pop()
+                receiver, sender = Pipe(duplex=False)
+                process = Process(
+                    target=_worker, args=(sender, function, args), daemon=True
+                )
+                process.start()
+                sender.close()
+                running[receiver] = (index, process)
+            for receiver in wait(list(running)):
+                index, process = running.pop(receiver)
+                try:
+                    result = receiver.recv()
+                except EOFError:
+                    raise RuntimeError('worker process failed')
+                finally:
+                    receiver.close()
+                    process.join()
+                yield index, result
+    finally:
+        for receiver, (index, process) in running.items():
+            process.terminate()
+            process.join()
+            receiver.close()
+
+
+def _fit_greedily(sizes, gamut_map, freespace, stats):
+    """The result of `Fitter.run_greedy` for the items, if it is valid;
+    otherwise None. `stats` is updated if it succeeds."""
+    fits = Fitter(sizes, gamut_map, freespace).run_greedy()
+    if fits is None or not is_valid_fit(sizes, gamut_map, freespace, fits):
+        return None
+    stats['path_greedy'] += 1
+    return fits
+
+
+def _fit_component(sizes, gamut_map, freespace):
+    """Fit one of the groups found by `Fitter.components`, possibly in a
+    worker process."""
+    stats = Counter()
+    fits = fit_items(sizes, gamut_map, freespace, stats)
+    return fits, stats
+
+
+def _search(sizes, gamut_map, freespace, seed):
+    """Run a single search for `fit_portfolio`, in a worker process."""
+    stats = Counter()
+    fits = Fitter(sizes, gamut_map, freespace, stats, seed).run()
+    return fits, stats
+
+
+def fit_portfolio(sizes, gamut_map, freespace, jobs, stats=None):
+    """As `Fitter(...).run()`, but runs `jobs` differently-ordered searches
+    at once, in separate worker processes. The first one to finish wins,
+    and the rest are cancelled: since each search is exhaustive, the first
+    result (whether success or failure) is conclusive. Search run times are
+    heavy-tailed, so this is often much faster than a single search.
+    `stats`, if provided, is updated with the statistics of the winner."""
+    # The first search uses the normal order; the rest are randomized.
+    tasks = [
+        (sizes, gamut_map, freespace, None if i == 0 else i)
+        for i in range(jobs)
+    ]
+    results = _in_processes(_search, tasks, jobs)
+    index, (fits, winner_stats) = next(results)
+    results.close()
+    if stats is not None:
+        stats.update(winner_stats)
+        stats['portfolio_winner'] = index
+    return fits
+
+
+def fit_items(sizes, gamut_map, freespace, stats=None, jobs=1):
+    """Find a location in the `freespace` for each item named in `sizes`,
+    subject to the `gamut_map`; return a dict of (name) -> (location), or
+    None if there is no way to fit everything.
+
+    A greedy placement is tried first, since it usually works. If it fails,
+    the items are split into independent groups that can't compete for the
+    same space, and each group is fitted separately (again trying a greedy
+    placement first), so that a hard group doesn't make the others search
+    along with it. `stats`, if provided, is a `Counter` updated with search
+    statistics, including which approach was used (`path_greedy` or
+    `path_search`), how many groups there were (`components`), and whether
+    fitting failed because there was certainly not enough space
+    (`no_capacity`).
+
+    If `jobs` is more than 1, the groups are fitted in parallel, or if there
+    is only one, the search is done by `fit_portfolio`."""
+    fitter = Fitter(sizes, gamut_map, freespace, stats)
+    stats = fitter.stats
+    fits = fitter.run_greedy()
+    if fits is not None and is_valid_fit(sizes, gamut_map, freespace, fits):
+        stats['path_greedy'] += 1
+        return fits
+    components = fitter.components()
+    if len(components) <= 1:
+        stats['path_search'] += 1
+        if jobs > 1:
+            return fit_portfolio(sizes, gamut_map, freespace, jobs, stats)
+        return fitter.run()
+    stats['components'] += len(components)
+    fits = fitter.preplaced()
+    if fits is None:
+        return None
+    tasks = [
+        (
+            {name: sizes[name] for name in names},
+            {name: gamut_map[name] for name in names},
+            component_free
+        )
+        for names, component_free in components
+    ]
+    if jobs > 1:
+        # Most groups can be placed greedily in much less time than it takes
+        # to start a worker process, so only the rest are sent to workers.
+        hard = []
+        for args in tasks:
+            component_fits = _fit_greedily(*args, stats=stats)
+            if component_fits is None:
+                hard.append(args)
+            else:
+                fits.update(component_fits)
+        results = _in_processes(_fit_component, hard, jobs)
+    else:
+        results = (
+            (index, _fit_component(*args)) for index, args in enumerate(tasks)
+        )
+    try:
+        for index, (component_fits, component_stats) in results:
+            stats.update(component_stats)
+            if component_fits is None:
+                return None # No point fitting the rest.
+            fits.update(component_fits)
+    finally:
+        results.close()
+    return fits
+
+
+def _kept_placements(sizes, gamut_map, freespace, previous):
+    """The placements from a `fit_record` (`previous`) that can be kept:
+    those of items whose size and gamut haven't changed, and which are
+    still within the `freespace` without overlapping each other."""
+    try:
+        placements = sorted(
+            (entry['at'], name, entry['size'], entry['gamut'])
+            for name, entry in previous.items()
+        )
+    except (AttributeError, KeyError, TypeError):
+        raise ValueError('Invalid fit record.')
+    kept, end = {}, None
+    for where, name, size, gamut in placements:
+        if name not in sizes or type(where) != int:
+            continue
+        if sizes[name] != size or gamut_data(gamut_map[name]) != gamut:
+            continue # Changed, so it needs to be fitted again.
+        if gamut is not None and where not in gamut_map[name]:
+            continue
+        if size > 0:
+            chunk = freespace.chunk_at(where)
+            if chunk is None or where + size > chunk[1]:
+                continue
+            if end is not None and where < end:
+                continue # Overlaps a placement that is already kept.
+            end = where + size
+        kept[name] = where
+    return kept
+
+
+def refit_items(sizes, gamut_map, freespace, previous, stats=None, jobs=1):
+    """As `fit_items`, but reusing the placements from a previous run, as
+    described by a `fit_record` (`previous`), wherever possible.
+    Only the items that are new or changed (or whose old placement is
+    otherwise no longer usable) are fitted, into the space that the rest
+    leave free. If that fails, the placements are kept only for groups of
+    items (as found by `Fitter.components`) with nothing to be re-fitted,
+    and the other groups are fitted from scratch."""
+    if stats is None:
+        stats = Counter()
+    kept = _kept_placements(sizes, gamut_map, freespace, previous)
+    remaining = freespace.copy()
+    for name, where in kept.items():
+        remaining.remove(where, sizes[name])
+    rest = [name for name in sizes if name not in kept]
+    fits = fit_items(
+        {name: sizes[name] for name in rest},
+        {name: gamut_map[name] for name in rest},
+        remaining, stats, jobs
     )
     if fits is not None:
-        fits = dict(fits)
+        stats['kept'] += len(kept)
+        fits.update(kept)
+        return fits
+    stats['refit_fallback'] += 1
+    # Running out of space around the kept placements proves nothing.
+    del stats['no_capacity']
+    fitter = Fitter(sizes, gamut_map, freespace, stats)
+    fits = fitter.preplaced()
+    if fits is None:
+        return None
+    for names, component_free in fitter.components():
+        if all(name in kept for name in names):
+            fits.update((name, kept[name]) for name in names)
+            continue
+        component_fits = fit_items(
+            {name: sizes[name] for name in names},
+            {name: gamut_map[name] for name in names},
+            component_free, stats, jobs
+        )
+        if component_fits is None:
+            return None
+        fits.update(component_fits)
+    return fits
+
+
+def fit_record(patch_map, roots, fit_map):
+    """JSON-compatible description of a `fit_map`, for use with
+    `refit_items`: the location, size and gamut of each item."""
+    sizes, gamut_map = _fitting_problem(patch_map, roots)
+    return {
+        name: {
+            'at': where,
+            'size': sizes[name],
+            'gamut': gamut_data(gamut_map[name])
+        }
+        for name, where in fit_map.items()
+    }
+
+
+def format_stats(stats):
+    """Human-readable summary of a search statistics `Counter`."""
+    if not stats:
+        return 'none'
+    return ', '.join(
+        '{}={}'.format(name, value) for name, value in sorted(stats.items())
+    )
+
+
+def _fitting_problem(patch_map, roots):
+    """Sizes and gamuts of the items to fit, as used by `Fitter`."""
+    gamut_map = make_gamut_map(patch_map, roots)
+    sizes = {name: len(patch_map[name]) for name in gamut_map}
+    return sizes, gamut_map
+
+
+def check_capacity(patch_map, roots, freespace):
+    """Quick check of whether there could possibly be enough `freespace`
+    for the patch items that would be written for the specified `roots`.
+    If this is False, `make_fit_map` would certainly fail."""
+    sizes, gamut_map = _fitting_problem(patch_map, roots)
+    return Fitter(sizes, gamut_map, freespace).has_capacity()
+
+
+def make_fit_map(
+    patch_map, roots, freespace, stats=None, jobs=1, cache=None, previous=None,
+    extent=None
+):
+    """Locations for the patch items to write for the specified `roots`, as
+    a dict of (name) -> (location); or None if they can't all be fitted.
+    If a `cache` (a `FitCache`) is specified, a fit map for the same
+    fitting problem is reused from it if possible (before any search is set
+    up, so that this is cheap), and a newly found one is added to it.
+    Otherwise, if a `fit_record` from a `previous` run is specified, its
+    placements are kept where possible (see `refit_items`).
+    Zero-length items are placed first, as per `empty_location` (within
+    the `extent`, if specified), and the rest are fitted around them."""
+    sizes, gamut_map = _fitting_problem(patch_map, roots)
+    empty = {}
+    for name, size in sizes.items():
+        if size == 0:
+            empty[name] = empty_location(gamut_map[name], extent)
+            if empty[name] is None:
+                return None
+    sizes = {name: size for name, size in sizes.items() if size}
+    gamut_map = {name: gamut_map[name] for name in sizes}
+    if cache is not None:
+        fits = cache.lookup(sizes, gamut_map, freespace)
+        if fits is not None:
+            if stats is not None:
+                stats['cache_hit'] += 1
+            fits.update(empty)
+            return fits
+    if previous is not None:
+        fits = refit_items(
+            sizes, gamut_map, freespace, previous, stats, jobs
+        )
+    else:
+        fits = fit_items(sizes, gamut_map, freespace, stats, jobs)
+    if fits is None:
+        return None
+    if cache is not None:
+        cache.store(sizes, gamut_map, freespace, fits)
+    fits.update(empty)
     return fits
@@ -0,0 +1,92 @@
+from hashlib import sha256
+import json, os
+from .constrain import gamut_data, is_valid_fit
+
+
+# Bump this if the key or file format changes, so old entries are ignored.
+_VERSION = 1
+
+
+def fit_key(sizes, gamut_map, freespace):
+    """Hash of everything that determines whether a fit map is valid: the
+    names, sizes and gamuts of the items, and the available freespace
+    (which includes any space allowed by the filesize limit)."""
+    problem = {
+        'version': _VERSION,
+        'items': [
+            [name, sizes[name], gamut_data(gamut_map[name])]
+            for name in sorted(sizes)
+        ],
+        'free': freespace.data
+    }
+    encoded = json.dumps(problem, sort_keys=True, separators=(',', ':'))
+    return sha256(encoded.encode('utf-8')).hexdigest()
+
+
+class FitCache:
+    """A directory of previously computed fit maps, one JSON file each,
+    named for the `fit_key` of the fitting problem. Once the files total
+    more than `max_bytes`, the least recently used ones are deleted."""
+
+
+    def __init__(self, directory, max_bytes):
+        self._directory = directory
+        self._max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+
+    def _path(self, key):
+        return os.path.join(self._directory, key + '.json')
+
+
+    def lookup(self, sizes, gamut_map, freespace):
+        """The cached fit map for this problem, or None if there isn't one.
+        A cached fit map is only returned if it is actually valid."""
+        path = self._path(fit_key(sizes, gamut_map, freespace))
+        try:
+            with open(path) as f:
+                fits = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(fits, dict) or not all(
+            type(where) == int for where in fits.values()
+        ) or not is_valid_fit(sizes, gamut_map, freespace, fits):
+            return None
+        os.utime(path) # Mark it as recently used.
+        return fits
+
+
+    def store(self, sizes, gamut_map, freespace, fits):
+        """Add a fit map to the cache, evicting old entries as needed."""
+        path = self._path(fit_key(sizes, gamut_map, freespace))
+        temp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp, 'w') as f:
+            json.dump(fits, f)
+        # Replacing atomically means a concurrent run never sees a
+        # partially-written entry.
+        os.replace(temp, path)
+        self._evict()
+
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self._directory):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self._directory, name)
+            try:
+                info = os.stat(path)
+            except OSError:
+                continue # Removed by someone else in the meantime.
+            entries.append((info.st_mtime, info.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        entries.sort()
+        # The newest entry is kept even if it's too big by itself.
+        for _, size, path in entries[:-1]:
+            if total <= self._max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
@@ -1,95 +1,301 @@
+from bisect import bisect_left, bisect_right, insort
 from collections import deque
+from mmap import mmap, ACCESS_READ
+import json, os, struct
 from .constrain import range_intersect
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# With at least this many chunks, candidates are computed with NumPy (if
+# available) for all the chunks at once.
+VECTOR_THRESHOLD = 64
+# NumPy's integers are 64-bit; locations must stay well within that.
+_VECTOR_LIMIT = 1 << 62
+# Binary freespace files start with this, followed by a (start, stop) pair
+# of little-endian 64-bit integers for each chunk.
+MAGIC = b'JBPFREE\x01'
+_PAIR = struct.Struct('<qq')
 
 
 class Freespace:
-    """Represents a set of "free" locations in the file to be patched."""
+    """Represents a set of "free" locations in the file to be patched.
+
+    Chunks are stored as parallel, sorted lists of start and stop positions,
+    so the chunks touched by an update can be located by bisection. Chunks
+    are also indexed by size, so that the ones big enough to hold an item of
+    a given size (or the smallest such) can be found without scanning the
+    others."""
     def __init__(self):
-        self._ranges = []
+        self._starts = []
+        self._stops = []
+        # Sorted list of (size, start) pairs for the chunks.
+        self._by_size = []
+        # Undo records for `rollback`; `None` until `checkpoint` is called.
+        self._journal = None
 
 
-    @property
-    def data(self):
-        return [[r.start, r.stop] for r in self._ranges]
-
-
-    def _ranges_with(self, start, size):
-        merged_start = start
-        merged_stop = start + size
-        merged_written = False
-        for r in self._ranges:
-            if r.stop < merged_start:
-                # Completely before the inserted range.
-                yield r
-            elif r.start > merged_stop:
-                # Completely after the inserted range.
-                # Ensure that the merged chunk is written first.
-                if not merged_written:
-                    yield range(merged_start, merged_stop)
-                merged_written = True
-                yield r
+    @classmethod
+    def from_ranges(cls, ranges):
+        """Create a Freespace from an iterable of (start, stop) pairs, in any
+        order and possibly overlapping, all at once."""
+        result = cls()
+        starts, stops = result._starts, result._stops
+        for start, stop in sorted(ranges):
+            if stop <= start:
+                continue
+            if stops and start <= stops[-1]:
+                # Overlapping or adjacent; merge with the previous one.
+                stops[-1] = max(stops[-1], stop)
             else:
-                # Overlaps; do merging.
-                merged_start = min(merged_start, r.start)
-                merged_stop = max(merged_stop, r.stop)
-        # Ensure merged chunk is written if there's nothing after it.
-        if not merged_written:
-            yield range(merged_start, merged_stop)
+                starts.append(start)
+                stops.append(stop)
+        result._by_size = sorted(
+            (stop - start, start) for start, stop in zip(starts, stops)
+        )
+        return result
 
 
-    def including(self, start, size):
+    def copy(self):
         result = Freespace()
-        result._ranges = list(self._ranges_with(start, size))
+        result._starts = self._starts[:]
+        result._stops = self._stops[:]
+        result._by_size = self._by_size[:]
         return result
 
 
+    @property
+    def data(self):
+        return [[start, stop] for start, stop in zip(self._starts, self._stops)]
+
+
+    def _replace(self, lo, hi, starts, stops):
+        """Replace the chunks at indices [lo:hi] with the specified ones,
+        keeping the size index up to date."""
+        by_size = self._by_size
+        for start, stop in zip(self._starts[lo:hi], self._stops[lo:hi]):
+            del by_size[bisect_left(by_size, (stop - start, start))]
+        for start, stop in zip(starts, stops):
+            insort(by_size, (stop - start, start))
+        self._starts[lo:hi] = starts
+        self._stops[lo:hi] = stops
+
+
+    def _splice(self, lo, hi, starts, stops):
+        """As `_replace`, but journalled (if enabled) so it can be undone."""
+        if self._journal is not None:
+            self._journal.append(
+                (lo, len(starts), self._starts[lo:hi], self._stops[lo:hi])
+            )
+        self._replace(lo, hi, starts, stops)
+
+
+    def checkpoint(self):
+        """Start journalling changes to this Freespace (if not already), and
+        return a marker that can be passed to `rollback`."""
+        if self._journal is None:
+            self._journal = []
+        return len(self._journal)
+
+
+    def rollback(self, marker):
+        """Undo every change made since `checkpoint` returned `marker`.
+        Each undone `add` or `remove` costs a single splice."""
+        journal = self._journal
+        while len(journal) > marker:
+            lo, count, starts, stops = journal.pop()
+            self._replace(lo, lo + count, starts, stops)
+
+
     def add(self, start, size):
-        self._ranges = list(self._ranges_with(start, size))
+        if size <= 0:
+            return
+        stop = start + size
+        # Chunks that overlap or are adjacent to the new one get merged.
+        lo = bisect_left(self._stops, start)
+        hi = bisect_right(self._starts, stop)
+        if lo < hi:
+            start = min(start, self._starts[lo])
+            stop = max(stop, self._stops[hi - 1])
+        self._splice(lo, hi, [start], [stop])
 
 
-    def _ranges_without(self, start, size):
-        removed_start = start
-        removed_stop = start + size
-        for r in self._ranges:
-            if r.stop <= removed_start or r.start >= removed_stop:
-                # No overlap.
-                yield r
-            else:
-                # Do the appropriate clipping.
-                # May produce 0-2 clips.
-                if r.start < removed_start:
-                    yield range(r.start, removed_start)
-                if r.stop > removed_stop:
-                    yield range(removed_stop, r.stop)
+    def including(self, start, size):
+        result = self.copy()
+        result.add(start, size)
+        return result
+
+
+    def remove(self, start, size):
+        if size <= 0:
+            return
+        stop = start + size
+        lo = bisect_right(self._stops, start)
+        hi = bisect_left(self._starts, stop)
+        if lo >= hi:
+            return # No overlap.
+        # Do the appropriate clipping. May produce 0-2 clips.
+        starts, stops = [], []
+        if self._starts[lo] < start:
+            starts.append(self._starts[lo])
+            stops.append(start)
+        if self._stops[hi - 1] > stop:
+            starts.append(stop)
+            stops.append(self._stops[hi - 1])
+        self._splice(lo, hi, starts, stops)
 
 
     def excluding(self, start, size):
-        result = Freespace()
-        result._ranges = list(self._ranges_without(start, size))
+        result = self.copy()
+        result.remove(start, size)
         return result
 
 
-    def remove(self, start, size):
-        self._ranges = list(self._ranges_without(start, size))
+    def chunk_at(self, position):
+        """The (start, stop) pair for the chunk containing `position`,
+        or None if that location isn't free."""
+        i = bisect_right(self._starts, position) - 1
+        if i >= 0 and position < self._stops[i]:
+            return self._starts[i], self._stops[i]
+        return None
+
+
+    def chunks_fitting(self, size):
+        """List of (start, stop) pairs for chunks of at least `size` bytes,
+        in ascending order."""
+        big_enough = self._by_size[bisect_left(self._by_size, (size,)):]
+        return sorted((start, start + length) for length, start in big_enough)
+
+
+    def best_fit(self, size, pointer_gamut):
+        """The first location, subject to the `pointer_gamut`, in the
+        smallest chunk that could hold an item of the specified `size`;
+        or None if there is nowhere it could go."""
+        by_size = self._by_size
+        first = bisect_left(by_size, (size,))
+        if pointer_gamut is not None:
+            i = bisect_right(self._stops, pointer_gamut.start)
+            end = bisect_left(self._starts, pointer_gamut.stop)
+            if end - i < len(by_size) - first:
+                # Fewer chunks overlap the gamut; check those instead.
+                chunks = sorted(
+                    (stop - start, start) for start, stop
+                    in zip(self._starts[i:end], self._stops[i:end])
+                    if stop - start >= size
+                )
+                by_size, first = chunks, 0
+        for length, start in by_size[first:]:
+            options = range_intersect(
+                range(start, start + length - size + 1), pointer_gamut
+            )
+            if options:
+                return options[0]
+        return None
 
 
     def _candidate_ranges(self, size, pointer_gamut):
-        for r in self._ranges:
-            if size == 0:
-                # Special case: zero-length patch items can go anywhere.
+        if size == 0:
+            # Special case: zero-length patch items can go anywhere.
+            for _ in self._starts:
                 yield range(0, 1)
-            else:
-                yield range_intersect(
-                    range(r.start, r.stop - size + 1), pointer_gamut
-                )
+            return
+        for start, stop in self.chunks_fitting(size):
+            yield range_intersect(range(start, stop - size + 1), pointer_gamut)
+
+
+    def candidate_arrays(self, size, pointer_gamut):
+        """Places where a patch item of the specified `size` could be written
+        in each chunk, subject to the `pointer_gamut`, computed with NumPy
+        for all the chunks at once. Returns arrays of (first, stop, count)
+        for each chunk, along with the step between places; or None if
+        there are too few chunks for this to be worthwhile, or NumPy isn't
+        available or can't represent the values."""
+        if numpy is None or size <= 0:
+            return None
+        starts, stops = self._starts, self._stops
+        if len(starts) < VECTOR_THRESHOLD:
+            return None
+        if stops[-1] >= _VECTOR_LIMIT or starts[0] < 0:
+            return None
+        starts = numpy.array(starts, dtype=numpy.int64)
+        # The last place an item could start in each chunk, plus one.
+        limits = numpy.array(stops, dtype=numpy.int64) - (size - 1)
+        if pointer_gamut is None:
+            step = 1
+            firsts = starts
+        else:
+            step = pointer_gamut.step
+            if step >= _VECTOR_LIMIT:
+                return None
+            # Clip the gamut to the chunks, so that it fits in the arrays.
+            lowest, highest = int(starts[0]), int(limits[-1])
+            low = min(max(pointer_gamut.start, lowest), highest)
+            high = max(min(pointer_gamut.stop, highest), lowest)
+            limits = numpy.minimum(limits, high)
+            firsts = numpy.maximum(starts, low)
+            # Round up to the next value in the gamut.
+            residue = pointer_gamut.start % step
+            firsts = firsts + (residue - firsts) % step
+        counts = numpy.maximum(0, -((firsts - limits) // step))
+        return firsts, numpy.maximum(firsts, limits), counts, step
 
 
     def candidates(self, size, pointer_gamut):
         """Iterable of places where a patch item of the specified `size`
         could be written in this Freespace, subject to the `pointer_gamut`."""
+        if size > 0:
+            # Chunks too small for the item just have no locations.
+            arrays = self.candidate_arrays(size, pointer_gamut)
+            if arrays is not None:
+                firsts, _, counts, step = arrays
+                return ArrayCandidates(firsts, counts, step)
         return Candidates(tuple(self._candidate_ranges(size, pointer_gamut)))
 
 
+    def iter_candidates(self, size, pointer_gamut, lowest=None, shuffle=None):
+        """Generate the same locations, in the same order, as iterating over
+        `self.candidates(size, pointer_gamut)`, but lazily, so that trying
+        only the first few is cheap. The Freespace must be in the same state
+        every time the generator is resumed.
+        If `lowest` is specified, locations before that are skipped.
+        If `shuffle` (a `random.Random` instance) is specified, it is used to
+        visit the chunks in a random order instead of ascending order."""
+        if size == 0:
+            yield from Candidates(tuple(self._candidate_ranges(0, None)))
+            return
+        starts, stops = self._starts, self._stops
+        i, end = 0, len(starts)
+        if pointer_gamut is not None:
+            # Skip chunks that are entirely outside the gamut.
+            i = bisect_right(stops, pointer_gamut.start)
+            end = bisect_left(starts, pointer_gamut.stop)
+        if lowest is not None:
+            i = max(i, bisect_right(stops, lowest))
+        # The first round visits each chunk in turn; the rest are handled
+        # as in `Candidates`.
+        pending = deque()
+        order = range(i, end)
+        if shuffle is not None:
+            order = list(order)
+            shuffle.shuffle(order)
+        for j in order:
+            start, stop = starts[j], stops[j]
+            if lowest is not None:
+                start = max(start, lowest)
+            if stop - start < size:
+                continue
+            options = iter(
+                range_intersect(range(start, stop - size + 1), pointer_gamut)
+            )
+            for candidate in options:
+                yield candidate
+                pending.append(options)
+                break
+        yield from Candidates(pending)
+
+
 class Candidates:
     def __init__(self, ranges):
         self._ranges = ranges
@@ -108,3 +314,95 @@ class Candidates:
 
     def __len__(self):
         return sum(map(len, self._ranges))
+
+
+class ArrayCandidates:
+    """As `Candidates`, but for ranges represented by arrays of (first,
+    count) values (as returned by `Freespace.candidate_arrays`)."""
+    def __init__(self, firsts, counts, step):
+        self._firsts = firsts
+        self._counts = counts
+        self._step = step
+
+
+    def __iter__(self):
+        # Each round takes the next location from every chunk that has one.
+        # Chunks are dropped as they run out, so that a round costs only as
+        # much as the locations it produces; once there are too few left for
+        # NumPy to be worthwhile, the rest are handled as in `Candidates`.
+        step = self._step
+        remaining = self._counts > 0
+        firsts, counts = self._firsts[remaining], self._counts[remaining]
+        done = 0
+        while len(counts) >= VECTOR_THRESHOLD:
+            last = int(counts.min())
+            for i in range(done, last):
+                yield from (firsts + i * step).tolist()
+            done = last
+            remaining = counts > last
+            firsts, counts = firsts[remaining], counts[remaining]
+        yield from Candidates([
+            range(first + done * step, first + count * step, step)
+            for first, count in zip(firsts.tolist(), counts.tolist())
+        ])
+
+
+    def __len__(self):
+        return int(self._counts.sum())
+
+
+def is_binary_freespace(filename):
+    with open(filename, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def read_freespace(filename):
+    """Load a freespace file, in either the binary or the JSON format.
+    Returns the Freespace, and whether the file was binary."""
+    if not is_binary_freespace(filename):
+        with open(filename) as f:
+            return Freespace.from_ranges(map(tuple, json.load(f))), False
+    with open(filename, 'rb') as f:
+        with mmap(f.fileno(), 0, access=ACCESS_READ) as data:
+            if (len(data) - len(MAGIC)) % _PAIR.size:
+                raise ValueError('{} is truncated'.format(filename))
+            with memoryview(data) as view:
+                return Freespace.from_ranges(
+                    _PAIR.iter_unpack(view[len(MAGIC):])
+                ), True
+
+
+def encode_freespace(freespace, binary):
+    """The contents of a freespace file for a Freespace, in the binary or the
+    JSON format. The binary format can only represent locations that fit in
+    a signed 64-bit integer."""
+    if not binary:
+        return json.dumps(freespace.data).encode('utf-8')
+    try:
+        return MAGIC + b''.join(
+            _PAIR.pack(start, stop)
+            for start, stop in zip(freespace._starts, freespace._stops)
+        )
+    except struct.error:
+        raise ValueError(
+            'Freespace is too large for the binary format; use JSON instead.'
+        )
+
+
+def replace_file(filename, data):
+    """Write `data` to the named file. A regular file is replaced
+    atomically, so that it's never left partially written."""
+    if os.path.exists(filename) and not os.path.isfile(filename):
+        # Such as a device; it can only be written directly.
+        with open(filename, 'wb') as f:
+            f.write(data)
+        return
+    temp = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(temp, 'wb') as f:
+        f.write(data)
+    os.replace(temp, filename)
+
+
+def write_freespace(freespace, filename, binary):
+    """Save a Freespace to a file, in the binary or the JSON format."""
+    replace_file(filename, encode_freespace(freespace, binary))
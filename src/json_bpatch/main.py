@@ -1,8 +1,9 @@
 from base64 import b64decode
 from collections import ChainMap
+from collections.abc import Mapping
 from functools import partial
 import json
-from .patch import Datum, Patch, Pointer
+from .patch import Datum, FileDatum, Patch, Pointer
 
 
 def get_param(params, expected_type, name):
@@ -14,7 +15,9 @@ def get_param(params, expected_type, name):
     return value
 
 
-def make_pointer(defaults, settings):
+def encoding_params(defaults, settings):
+    """Validated (offset, size, align, stride, signed, bigendian) settings
+    for how a pointer value is encoded."""
     params = ChainMap(settings, defaults)
     offset = get_param(params, int, 'offset')
     size = get_param(params, int, 'size')
@@ -26,16 +29,25 @@ def make_pointer(defaults, settings):
         raise ValueError('size cannot be negative')
     if align < 1 or (align & (align - 1)):
         raise ValueError('align must be a power of two')
+    return offset, size, align, stride, signed, bigendian
+
+
+def pointer_params(defaults, settings):
+    """Validated arguments for creating a Pointer."""
+    encoding = encoding_params(defaults, settings)
     # Should not appear in the `defaults`, and always be specified.
-    referent = get_param(params, str, 'referent')
-    return Pointer(referent, offset, size, align, stride, signed, bigendian)
+    referent = get_param(settings, str, 'referent')
+    return (referent,) + encoding
+
+
+def make_pointer(defaults, settings):
+    return Pointer(*pointer_params(defaults, settings))
 
 
 def make_datum(s):
     if s.startswith('@'):
-        filename = s[1:]
-        with open(filename, 'rb') as f:
-            data = f.read()
+        # The file is only read when the data is written.
+        return FileDatum(s[1:])
     elif s.startswith('='):
         data = b64decode(s) # the '=' will be handled automatically.
     else:
@@ -53,18 +65,21 @@ def make_item_with_defaults(defaults, data):
         raise ValueError('Patch item must be a Datum or a Pointer')
 
 
-def item_factory(defaults):
-    # Sanitize defaults.
+def sanitize_defaults(defaults):
     if 'referent' in defaults:
         raise ValueError('default value for referent may not be specified')
-    return partial(make_item_with_defaults, {
+    return {
         'offset': get_param(defaults, int, 'offset'),
         'size': get_param(defaults, int, 'size'),
         'align': get_param(defaults, int, 'align'),
         'stride': get_param(defaults, int, 'stride'),
         'signed': get_param(defaults, bool, 'signed'),
         'bigendian': get_param(defaults, bool, 'bigendian'),
-    })
+    }
+
+
+def item_factory(defaults):
+    return partial(make_item_with_defaults, sanitize_defaults(defaults))
 
 
 def load_patch_item(item_loader, patch):
@@ -73,11 +88,38 @@ def load_patch_item(item_loader, patch):
     return Patch(list(map(item_loader, patch)))
 
 
+class PatchMap(Mapping):
+    """Mapping of names to Patches, created from the parsed JSON for each
+    as it is first looked up. Since only the items reachable from the
+    roots are looked up, the rest are never processed."""
+    def __init__(self, parsed_json, item_loader):
+        self._json = parsed_json
+        self._item_loader = item_loader
+        self._patches = {}
+
+
+    def __getitem__(self, name):
+        try:
+            return self._patches[name]
+        except KeyError:
+            pass
+        patch = load_patch_item(self._item_loader, self._json[name])
+        self._patches[name] = patch
+        return patch
+
+
+    def __iter__(self):
+        return iter(self._json)
+
+
+    def __len__(self):
+        return len(self._json)
+
+
 def load(parsed_json, defaults):
     if not isinstance(parsed_json, dict):
         raise ValueError('data must be a JSON object with Patches as values')
-    make_item = item_factory(defaults)
-    return {k: load_patch_item(make_item, v) for k, v in parsed_json.items()}
+    return PatchMap(parsed_json, item_factory(defaults))
 
 
 def get_json(filename):
@@ -1,4 +1,22 @@
-from .constrain import range_intersect
+from struct import Struct
+import os
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# How much of a file to copy at a time, when it can't be done by the OS.
+COPY_SIZE = 1 << 20
+# `struct` format codes for Pointers, by (size, signed).
+POINTER_CODES = {
+    (1, False): 'B', (1, True): 'b',
+    (2, False): 'H', (2, True): 'h',
+    (4, False): 'I', (4, True): 'i',
+    (8, False): 'Q', (8, True): 'q'
+}
+# Runs of at least this many Pointers are encoded with NumPy, if available.
+NUMPY_THRESHOLD = 256
 
 
 class Datum:
@@ -14,6 +32,14 @@ class Datum:
         return self._raw
 
 
+    def write_into(self, to_patch, where, fit_map):
+        to_patch[where:where + len(self)] = self.data(fit_map)
+
+
+    def write_to_file(self, fd, where, fit_map):
+        os.pwrite(fd, self.data(fit_map), where)
+
+
     def constrain(self, candidate_map, processed, to_process):
         pass
 
@@ -22,6 +48,77 @@ class Datum:
         return '<Datum: "{}">'.format(self._raw)
 
 
+class FileDatum:
+    """A Datum whose contents come from a file. Only the size of the file
+    is checked up front; the contents are copied directly from the file
+    when they're written."""
+    def __init__(self, filename):
+        self._filename = filename
+        self._size = os.path.getsize(filename)
+
+
+    def __len__(self):
+        return self._size
+
+
+    def data(self, fit_map):
+        with open(self._filename, 'rb') as f:
+            raw = f.read(self._size)
+        if len(raw) != self._size:
+            raise ValueError('{} changed size'.format(self._filename))
+        return raw
+
+
+    def write_into(self, to_patch, where, fit_map):
+        with open(self._filename, 'rb') as f:
+            view = memoryview(to_patch)[where:where + self._size]
+            try:
+                while view:
+                    count = f.readinto(view)
+                    if not count:
+                        raise ValueError(
+                            '{} changed size'.format(self._filename)
+                        )
+                    view = view[count:]
+            finally:
+                view.release()
+
+
+    def write_to_file(self, fd, where, fit_map):
+        """Copy the contents into the open file `fd` at `where`, within
+        the OS where possible."""
+        with open(self._filename, 'rb') as f:
+            source, offset = f.fileno(), 0
+            if hasattr(os, 'copy_file_range'):
+                try:
+                    while offset < self._size:
+                        count = os.copy_file_range(
+                            source, fd, self._size - offset,
+                            offset, where + offset
+                        )
+                        if not count:
+                            break
+                        offset += count
+                except OSError:
+                    pass # Not supported here; copy the rest by hand.
+            while offset < self._size:
+                chunk = os.pread(
+                    source, min(COPY_SIZE, self._size - offset), offset
+                )
+                if not chunk:
+                    raise ValueError('{} changed size'.format(self._filename))
+                os.pwrite(fd, chunk, where + offset)
+                offset += len(chunk)
+
+
+    def constrain(self, candidate_map, processed, to_process):
+        pass
+
+
+    def __repr__(self):
+        return '<FileDatum: "{}">'.format(self._filename)
+
+
 class Pointer:
     def __init__(self, ref, offset, size, align, stride, signed, bigendian):
         self._referent = ref
@@ -29,16 +126,21 @@ class Pointer:
         self._mask = align - 1
         bits = size * 8
         low = -((1 << bits) >> 1) if signed else 0
-        high = 0 if size == 0 else ((2 << bits) - 1 + low)
+        high = 0 if size == 0 else ((1 << bits) - 1 + low)
         self._gamut = range(
             stride * (low if stride > 0 else high) + offset,
             stride * (high if stride > 0 else low) + offset + 1,
             abs(stride) * align
         )
-        s = range(0, size * 8, 8)
-        self._shifts = reversed(s) if bigendian else s
+        self._byteorder = 'big' if bigendian else 'little'
+        self._signed = signed
         self._stride = stride
         self._size = size
+        # The `struct` format for the value, if there is one.
+        code = POINTER_CODES.get((size, signed))
+        self.format = None if code is None else (
+            ('>' if bigendian else '<') + code
+        )
 
 
     def __len__(self):
@@ -52,24 +154,36 @@ class Pointer:
         return self._gamut
 
 
-    def data(self, fit_map):
-        """The bytes used by this pointer, given the specified `fit_map`.
+    def value(self, fit_map):
+        """The value of this pointer, given the specified `fit_map`.
         The referent of this pointer must be mentioned in the map."""
         address = fit_map[self._referent]
         if not self._gamut.start <= address < self._gamut.stop:
             raise ValueError("Address out of bounds")
         if address not in self._gamut:
             raise ValueError("Improperly aligned address")
-        value = (address - self._offset) // self._stride
-        return bytes((value >> shift) & 0xff for shift in self._shifts)
+        return (address - self._offset) // self._stride
 
 
-    def constrain(self, gamut_map, processed, to_process):
-        """Apply constraint implied by this pointer to the `gamut_map`."""
-        gamut_map[self._referent] = range_intersect(
-            gamut_map.get(self._referent, None),
-            self.gamut
+    def data(self, fit_map):
+        """The bytes used by this pointer, given the specified `fit_map`."""
+        return self.value(fit_map).to_bytes(
+            self._size, self._byteorder, signed=self._signed
         )
+
+
+    def write_into(self, to_patch, where, fit_map):
+        to_patch[where:where + len(self)] = self.data(fit_map)
+
+
+    def write_to_file(self, fd, where, fit_map):
+        os.pwrite(fd, self.data(fit_map), where)
+
+
+    def constrain(self, constraint_map, processed, to_process):
+        """Record the constraint implied by this pointer in the
+        `constraint_map` (a map of names to lists of gamuts)."""
+        constraint_map.setdefault(self._referent, []).append(self.gamut)
         if self._referent not in processed:
             to_process.add(self._referent)
 
@@ -78,6 +192,96 @@ class Pointer:
         return '<Pointer to "{}", in {}>'.format(self._referent, self.gamut)
 
 
+class PointerRun:
+    """A sequence of consecutive Pointers with the same `struct` format,
+    which are encoded all at once."""
+    def __init__(self, pointers):
+        self._pointers = pointers
+        fmt = pointers[0].format
+        self._struct = Struct('{}{}{}'.format(fmt[0], len(pointers), fmt[1]))
+        self._dtype = fmt[0] + {
+            'B': 'u1', 'b': 'i1', 'H': 'u2', 'h': 'i2',
+            'I': 'u4', 'i': 'i4', 'Q': 'u8', 'q': 'i8'
+        }[fmt[1]]
+        self._arrays = None
+
+
+    def __len__(self):
+        return self._struct.size
+
+
+    def _values(self, fit_map):
+        return [pointer.value(fit_map) for pointer in self._pointers]
+
+
+    def _encoded(self, fit_map):
+        """The encoded data, computed with NumPy; or None if there are any
+        invalid addresses (so that the error can be reported as usual), or
+        the values are too big for NumPy's 64-bit integers."""
+        if self._arrays is None:
+            # The parameters of each pointer, as 64-bit integers.
+            try:
+                self._arrays = numpy.array([
+                    (
+                        p.gamut.start, p.gamut.stop, p.gamut.step,
+                        p._offset, p._stride
+                    )
+                    for p in self._pointers
+                ], dtype=numpy.int64).T
+            except OverflowError:
+                self._arrays = False
+        if self._arrays is False:
+            return None
+        starts, stops, steps, offsets, strides = self._arrays
+        try:
+            addresses = numpy.fromiter(
+                (fit_map[p._referent] for p in self._pointers),
+                dtype=numpy.int64, count=len(self._pointers)
+            )
+        except OverflowError:
+            return None
+        valid = (starts <= addresses) & (addresses < stops)
+        valid &= (addresses - starts) % steps == 0
+        if not valid.all():
+            return None
+        values = (addresses - offsets) // strides
+        return values.astype(self._dtype).tobytes()
+
+
+    def _use_numpy(self):
+        return (
+            numpy is not None and len(self._pointers) >= NUMPY_THRESHOLD
+        )
+
+
+    def data(self, fit_map):
+        if self._use_numpy():
+            encoded = self._encoded(fit_map)
+            if encoded is not None:
+                return encoded
+        return self._struct.pack(*self._values(fit_map))
+
+
+    def write_into(self, to_patch, where, fit_map):
+        if self._use_numpy():
+            to_patch[where:where + len(self)] = self.data(fit_map)
+        else:
+            self._struct.pack_into(to_patch, where, *self._values(fit_map))
+
+
+    def write_to_file(self, fd, where, fit_map):
+        os.pwrite(fd, self.data(fit_map), where)
+
+
+    def constrain(self, constraint_map, processed, to_process):
+        for pointer in self._pointers:
+            pointer.constrain(constraint_map, processed, to_process)
+
+
+    def __repr__(self):
+        return '<PointerRun: {}>'.format(self._pointers)
+
+
 class Patch:
     """Represents a contiguous chunk of data to be written by the patcher,
     specified as a sequence of either Datum objects (representing fixed byte
@@ -85,6 +289,27 @@ class Patch:
     another Patch)."""
     def __init__(self, components):
         self._components = components
+        self._segments = None
+
+
+    def _grouped(self):
+        """The components, with each run of consecutive Pointers that have
+        the same `struct` format combined into a PointerRun."""
+        if self._segments is None:
+            segments, run = [], []
+            for component in self._components + [None]:
+                fmt = getattr(component, 'format', None)
+                if run and (fmt is None or fmt != run[0].format):
+                    segments.append(
+                        run[0] if len(run) == 1 else PointerRun(run)
+                    )
+                    run = []
+                if fmt is not None:
+                    run.append(component)
+                elif component is not None:
+                    segments.append(component)
+            self._segments = segments
+        return self._segments
 
 
     def __len__(self):
@@ -92,8 +317,8 @@ class Patch:
 
 
     def constrain(self, candidate_map, processed, to_process):
-        """Iterate over components and have each apply its constraints
-        to the `candidate_map`. As a side effect, update the "open" set
+        """Iterate over components and have each record its constraints
+        in the `candidate_map`. As a side effect, update the "open" set
         for the transitive cover operation."""
         for component in self._components:
             component.constrain(candidate_map, processed, to_process)
@@ -101,25 +326,32 @@ class Patch:
 
     def write_into(self, to_patch, where, fit_map):
         """Write the data represented by this Patch, into `to_patch`.
-        `to_patch` -> `bytearray` representing the entire file being patched.
+        `to_patch` -> `bytearray` representing the entire file being patched
+        (or another writable buffer, such as an `mmap`, that is already long
+        enough to hold this Patch at `where`).
         `where` -> int location where this patch goes.
         `fit_map` -> map of (str: name of patch) -> (int: location to write).
         Used by Pointers to compute their values."""
         assert where >= 0
-        # Ensure the array is long enough that we can start writing at 'where'.
-        # Multiplying a list by a negative value produces an empty list, so
-        # the resulting behaviour is what we want.
-        to_patch.extend([0] * (where - len(to_patch)))
+        # Ensure the array is long enough to hold the entire Patch, so that
+        # each component writes within the existing data. (Zero-length
+        # Patches write nothing, so they never extend it.)
+        end = where + len(self)
+        if end > len(to_patch) and end > where:
+            to_patch.extend(bytes(end - len(to_patch)))
         # Write the individual components.
-        for component in self._components:
-            data = component.data(fit_map)
-            end = where + len(data)
-            # This works regardless of whether the write is in the middle,
-            # overlapping the end or at the end. Because of the initial padding,
-            # it cannot be past the end; and because `where >= 0`, it cannot
-            # overlap the beginning.
-            to_patch[where:end] = data
-            where = end
+        for component in self._grouped():
+            component.write_into(to_patch, where, fit_map)
+            where += len(component)
+
+
+    def write_to_file(self, fd, where, fit_map):
+        """Write the data represented by this Patch into the open file `fd`
+        (a file descriptor), at `where`, without changing the file position.
+        As with `write_into`, the `fit_map` is used for Pointer values."""
+        for component in self._grouped():
+            component.write_to_file(fd, where, fit_map)
+            where += len(component)
 
 
     def __repr__(self):
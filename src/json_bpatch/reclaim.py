@@ -0,0 +1,125 @@
+from collections import ChainMap
+from struct import Struct
+import os
+from .main import encoding_params, get_json, get_param
+from .patch import POINTER_CODES
+
+
+class PointerTable:
+    """Describes a table of pointers in the original file, to the data that
+    a patch replaces. The data pointed at can be reclaimed as freespace.
+
+    Each referenced region is either `length` bytes long, or (if `end` is
+    specified instead) extends up to the next referenced location, with
+    the last one ending at `end`. Entries with the `null` value (if any)
+    are ignored. If `free_table` is set, the table itself is also freed."""
+    def __init__(
+        self, at, count, encoding, length=None, end=None, null=None,
+        free_table=False
+    ):
+        self._at = at
+        self._count = count
+        self._offset, self._size, _, self._stride, signed, bigendian = encoding
+        self._signed = signed
+        self._byteorder = 'big' if bigendian else 'little'
+        code = POINTER_CODES.get((self._size, signed))
+        self._struct = None if code is None else Struct('{}{}{}'.format(
+            '>' if bigendian else '<', count, code
+        ))
+        self._length = length
+        self._end = end
+        self._null = null
+        self._free_table = free_table
+
+
+    def values(self, fd):
+        """The raw value of every entry, read from the open file `fd`."""
+        raw = os.pread(fd, self._count * self._size, self._at)
+        if len(raw) < self._count * self._size:
+            raise ValueError(
+                'pointer table at {} is past the end of the file'.format(
+                    self._at
+                )
+            )
+        if self._struct is not None:
+            return self._struct.unpack(raw)
+        size, byteorder, signed = self._size, self._byteorder, self._signed
+        return [
+            int.from_bytes(raw[i:i + size], byteorder, signed=signed)
+            for i in range(0, len(raw), size)
+        ]
+
+
+    def addresses(self, fd):
+        """The location referenced by every (non-null) entry."""
+        offset, stride, null = self._offset, self._stride, self._null
+        return [
+            value * stride + offset
+            for value in self.values(fd) if value != null
+        ]
+
+
+    def regions(self, fd):
+        """(start, stop) pairs for the regions that can be reclaimed."""
+        addresses = self.addresses(fd)
+        if self._length is not None:
+            result = [(a, a + self._length) for a in addresses]
+        else:
+            addresses = sorted(set(addresses))
+            if addresses and addresses[-1] > self._end:
+                raise ValueError(
+                    'pointer table at {} refers past the end at {}'.format(
+                        self._at, self._end
+                    )
+                )
+            result = list(zip(addresses, addresses[1:] + [self._end]))
+        if self._free_table:
+            result.append((self._at, self._at + self._count * self._size))
+        return result
+
+
+def make_table(defaults, settings):
+    if not isinstance(settings, dict):
+        raise ValueError('Pointer table must be a JSON object')
+    # The table is only read, so `align` doesn't matter and isn't required.
+    encoding = encoding_params(defaults, ChainMap(settings, {'align': 1}))
+    if encoding[1] == 0:
+        raise ValueError('pointer table entries must have nonzero size')
+    count = get_param(settings, int, 'count')
+    if count < 0:
+        raise ValueError('count cannot be negative')
+    length = settings.get('length')
+    end = settings.get('end')
+    if (length is None) == (end is None):
+        raise ValueError('exactly one of length and end must be specified')
+    if length is not None:
+        length = get_param(settings, int, 'length')
+    else:
+        end = get_param(settings, int, 'end')
+    null = settings.get('null')
+    if null is not None:
+        null = get_param(settings, int, 'null')
+    free_table = settings.get('free_table', False)
+    if type(free_table) != bool:
+        raise TypeError('free_table must be a bool')
+    return PointerTable(
+        get_param(settings, int, 'at'), count, encoding,
+        length, end, null, free_table
+    )
+
+
+def load_tables(filename, defaults):
+    """Read a file describing pointer tables: a JSON array of objects,
+    which use the same pointer settings (and `defaults`) as patches."""
+    data = get_json(filename)
+    if not isinstance(data, list):
+        raise ValueError('Reclaim file must be a JSON array of pointer tables')
+    return [make_table(defaults, settings) for settings in data]
+
+
+def reclaim_regions(filename, tables):
+    """Generate (start, stop) pairs for all the regions referenced by the
+    `tables` in the named file."""
+    with open(filename, 'rb') as f:
+        for table in tables:
+            yield from table.regions(f.fileno())
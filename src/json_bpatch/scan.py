@@ -0,0 +1,59 @@
+from mmap import mmap, ACCESS_READ
+import os, re
+
+
+def parse_scan(spec):
+    """Parse a freespace scan specification, of the form BYTE:MINLEN or
+    BYTE:MINLEN:START-END (numbers may be in any base Python recognizes,
+    e.g. 0xff). Returns (byte, min_length, window), where `window` is a
+    (start, end) pair or None."""
+    try:
+        parts = spec.split(':')
+        if len(parts) not in (2, 3):
+            raise ValueError
+        byte, min_length = int(parts[0], 0), int(parts[1], 0)
+        window = None
+        if len(parts) == 3:
+            start, end = parts[2].split('-')
+            window = int(start, 0), int(end, 0)
+        if not 0 <= byte < 256 or min_length < 1:
+            raise ValueError
+        return byte, min_length, window
+    except ValueError:
+        raise ValueError(
+            'Invalid specification for freespace scan: {}'.format(spec)
+        )
+
+
+def find_runs(data, byte, min_length, start=0, stop=None):
+    """Generate (start, stop) pairs for each run of at least `min_length`
+    copies of `byte` in `data` (any buffer, such as an `mmap`), within
+    [start:stop]. Runs are clipped to that window."""
+    if stop is None or stop > len(data):
+        stop = len(data)
+    start = max(start, 0)
+    needle = bytes([byte]) * min_length
+    other = re.compile(b'[^' + re.escape(bytes([byte])) + b']')
+    find = data.find
+    while start < stop:
+        # The first match for the whole needle is at the start of a run,
+        # so only the end of the run needs to be found.
+        begin = find(needle, start, stop)
+        if begin == -1:
+            return
+        end = other.search(data, begin + min_length, stop)
+        end = stop if end is None else end.start()
+        yield begin, end
+        start = end
+
+
+def scan_file(filename, scans):
+    """Generate (start, stop) pairs for every run found in the named file,
+    according to each of the `scans` (as returned by `parse_scan`)."""
+    if os.path.getsize(filename) == 0:
+        return # Can't map an empty file, and there's nothing to find.
+    with open(filename, 'rb') as f:
+        with mmap(f.fileno(), 0, access=ACCESS_READ) as data:
+            for byte, min_length, window in scans:
+                start, stop = (0, None) if window is None else window
+                yield from find_runs(data, byte, min_length, start, stop)
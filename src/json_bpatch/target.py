@@ -1,7 +1,12 @@
-import json, re
-from .constrain import make_fit_map
-from .main import get_json
-from .freespace import Freespace
+from collections import Counter
+from mmap import mmap
+import json, os, re, shutil, struct
+from .constrain import fit_record, format_stats, make_fit_map
+from .freespace import (
+    Freespace, encode_freespace, read_freespace, replace_file
+)
+from .reclaim import reclaim_regions
+from .scan import scan_file
 
 
 k, kb = 1024, 1000
@@ -19,6 +24,89 @@ suffixes = {
 suffix_pattern = re.compile('(.*?)([a-zA-Z]*)$')
 
 
+# How much of the original file to copy at a time when streaming.
+CHUNK_SIZE = 1 << 20
+
+
+def _copy_bytes(source, output, count):
+    """Copy `count` bytes from the `source` file to the `output` file,
+    padding with zeros if the source runs out."""
+    while count > 0:
+        chunk = source.read(min(count, CHUNK_SIZE))
+        if not chunk:
+            chunk = bytes(min(count, CHUNK_SIZE))
+        output.write(chunk)
+        count -= len(chunk)
+
+
+def journal_name(patch_name):
+    """Name of the journal file used when saving the named file in place."""
+    return patch_name + '.journal'
+
+
+def _fsync_directory(filename):
+    """Ensure that a file's directory entry (e.g. after renaming or removing
+    it) is on disk, where the OS allows it."""
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(filename)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _write_journal(patch_name, fd, size, ranges):
+    """Record the original `size` of the open file `fd`, and its contents
+    for each of the (start, stop) `ranges`, in a journal file. The journal
+    only appears once it's complete and on disk."""
+    name = journal_name(patch_name)
+    temp = name + '.tmp'
+    with open(temp, 'wb') as f:
+        f.write(struct.pack('<Q', size))
+        for start, stop in ranges:
+            original = os.pread(fd, stop - start, start)
+            f.write(struct.pack('<QQ', start, len(original)))
+            f.write(original)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp, name)
+    _fsync_directory(name)
+
+
+def recover_journal(patch_name):
+    """If a previous in-place save of the named file was interrupted, undo
+    it using its journal. Returns whether anything was done."""
+    name = journal_name(patch_name)
+    try:
+        # Only the writes after the journal was complete need undoing.
+        os.remove(name + '.tmp')
+    except OSError:
+        pass
+    try:
+        with open(name, 'rb') as f:
+            journal = f.read()
+    except OSError:
+        return False
+    size, = struct.unpack_from('<Q', journal)
+    position = 8
+    with open(patch_name, 'r+b') as f:
+        fd = f.fileno()
+        while position < len(journal):
+            start, length = struct.unpack_from('<QQ', journal, position)
+            position += 16
+            os.pwrite(fd, journal[position:position + length], start)
+            position += length
+        os.ftruncate(fd, size)
+        os.fsync(fd)
+    os.remove(name)
+    _fsync_directory(name)
+    return True
+
+
 def parse_filesize(s):
      try:
          number, suffix = suffix_pattern.match(s).groups()
@@ -32,37 +120,271 @@ class Target:
     along with bookkeeping information about the patching process."""
 
 
-    def __init__(self, patch_name, free_name, max_filesize):
-        with open(patch_name, 'rb') as f:
-            self._data = bytearray(f.read())
+    def __init__(self, patch_name, free_name, max_filesize, scans=()):
+        self._recover(patch_name)
+        self._name = patch_name
+        file_size = self._load(patch_name)
         self._free = Freespace()
+        # The freespace output uses the same format as the input.
+        self._free_binary = False
         if free_name is not None:
-            for start, end in get_json(free_name):
-                self._free.add(start, end - start)
+            self._free, self._free_binary = read_freespace(free_name)
+        if scans:
+            # Runs of filler bytes in the file are also free.
+            self._free = Freespace.from_ranges(
+                [tuple(chunk) for chunk in self._free.data]
+                + list(scan_file(patch_name, scans))
+            )
+        # How far the patched file may extend.
+        self._extent = file_size
         if max_filesize is not None:
             size = parse_filesize(max_filesize)
-            end = len(self._data)
-            self._free.add(end, size - end)
+            self._free.add(file_size, size - file_size)
+            self._extent = max(file_size, size)
+        # Ranges of the file that have been written to.
+        self._dirty = Freespace()
+        self._fit_record = None
+
+
+    def _recover(self, patch_name):
+        if recover_journal(patch_name):
+            print("Recovered {} from an interrupted save.".format(patch_name))
+
+
+    def _load(self, patch_name):
+        """Prepare to patch the named file; return its size."""
+        with open(patch_name, 'rb') as f:
+            self._data = bytearray(f.read())
+        return len(self._data)
+
+
+    def _report(self, name, where, size):
+        print("Writing: {} in [{}:{}]".format(name, where, where + size))
+
+
+    def _write(self, item, where, fit_map):
+        item.write_into(self._data, where, fit_map)
+
+
+    def reclaim(self, tables):
+        """Mark the data referenced by the specified `PointerTable`s in the
+        original file as free, since the patch replaces it."""
+        self._free = Freespace.from_ranges(
+            [tuple(chunk) for chunk in self._free.data]
+            + list(reclaim_regions(self._name, tables))
+        )
 
 
-    def write_patch(self, patch_map, roots=None):
+    def write_patch(
+        self, patch_map, roots=None, jobs=1, cache=None, previous=None
+    ):
         if roots is None:
             roots = [x for x in patch_map.keys() if x.startswith('_')]
-        fit_map = make_fit_map(patch_map, roots, self._free)
+        stats = Counter()
+        fit_map = make_fit_map(
+            patch_map, roots, self._free, stats, jobs, cache, previous,
+            self._extent
+        )
+        print("Fitting stats: {}".format(format_stats(stats)))
+        if fit_map is None and stats['no_capacity']:
+            raise ValueError("Fitting failed: not enough free space.")
         if fit_map is None:
             raise ValueError("Fitting failed.")
+        self._fit_record = fit_record(patch_map, roots, fit_map)
         for name, where in fit_map.items():
             what = patch_map[name]
-            print(
-                "Writing: {} in [{}:{}]".format(name, where, where + len(what))
-            )
-            what.write_into(self._data, where, fit_map)
+            self._report(name, where, len(what))
+            self._write(what, where, fit_map)
             self._free.remove(where, len(what))
+            self._dirty.add(where, len(what))
+
+
+    def save(
+        self, patch_name, free_name, fit_name=None, journal=False,
+        free_binary=None
+    ):
+        """Write the patched file and the bookkeeping files.
+        When saving over the original file, only the parts that changed are
+        written. With `journal`, the original contents of those parts are
+        saved first, so that if this is interrupted, the next attempt to
+        patch the file restores it (see `recover_journal`).
+        `free_binary` specifies whether to use the binary format for the
+        freespace file; by default, the input file's format is used."""
+        if free_binary is not None:
+            self._free_binary = free_binary
+        # Done first, so that if the freespace can't be saved, nothing is.
+        free_data = None if free_name is None else encode_freespace(
+            self._free, self._free_binary
+        )
+        if os.path.exists(patch_name) and os.path.samefile(
+            patch_name, self._name
+        ):
+            self._update(patch_name, journal)
+        else:
+            self._save_copy(patch_name)
+        self._save_records(free_name, free_data, fit_name)
+
+
+    def _update(self, patch_name, journal):
+        ranges = self._dirty.data
+        with open(patch_name, 'r+b') as f:
+            fd = f.fileno()
+            size = os.fstat(fd).st_size
+            if journal:
+                _write_journal(patch_name, fd, size, ranges)
+            self._apply(fd, size, ranges)
+            if journal:
+                os.fsync(fd)
+                os.remove(journal_name(patch_name))
+                _fsync_directory(patch_name)
 
 
-    def save(self, patch_name, free_name):
+    def _apply(self, fd, size, ranges):
+        """Write the specified (start, stop) `ranges` of the patched data
+        into the open file `fd`, currently of the given `size`."""
+        if len(self._data) > size:
+            os.ftruncate(fd, len(self._data))
+        data = memoryview(self._data)
+        for start, stop in ranges:
+            os.pwrite(fd, data[start:stop], start)
+
+
+    def _save_copy(self, patch_name):
         with open(patch_name, 'wb') as f:
             f.write(self._data)
+
+
+    def _save_records(self, free_name, free_data, fit_name):
         if free_name is not None:
-            with open(free_name, 'w') as f:
-                json.dump(self._free.data, f)
+            replace_file(free_name, free_data)
+        if fit_name is not None and self._fit_record is not None:
+            with open(fit_name, 'w') as f:
+                json.dump(self._fit_record, f, indent=1, sort_keys=True)
+
+
+class MappedTarget(Target):
+    """As `Target`, but the file is never read in. The items to write are
+    kept until `save`, which then copies the file (if necessary), extends
+    it (if necessary) and writes the items through a memory map, so that
+    only the patched pages are ever loaded."""
+
+
+    def _load(self, patch_name):
+        self._writes = []
+        return os.path.getsize(patch_name)
+
+
+    def _write(self, item, where, fit_map):
+        self._writes.append((where, item, fit_map))
+
+
+    def _apply(self, fd, size, ranges):
+        # Zero-length items don't extend the file, wherever they are.
+        end = max(
+            [
+                where + len(item)
+                for where, item, _ in self._writes if len(item)
+            ],
+            default=0
+        )
+        if end > size:
+            # The new space is filled with zeros (and may not take up
+            # any disk space until it's written).
+            os.ftruncate(fd, end)
+            size = end
+        if size > 0 and self._writes:
+            with mmap(fd, size) as view:
+                for where, item, fit_map in self._writes:
+                    item.write_into(view, where, fit_map)
+                view.flush()
+
+
+    def _save_copy(self, patch_name):
+        shutil.copyfile(self._name, patch_name)
+        self._update(patch_name, False)
+
+
+class StreamingTarget(Target):
+    """As `Target`, but the file is never read in, and nothing is written
+    until `save`. The output is then produced in a single sequential pass,
+    copying the original file a chunk at a time and splicing in the patch
+    items as they come up, so that memory use doesn't depend on the size
+    of the file."""
+
+
+    def _load(self, patch_name):
+        self._writes = []
+        return os.path.getsize(patch_name)
+
+
+    def _write(self, item, where, fit_map):
+        self._writes.append((where, item, fit_map))
+
+
+    def _items(self):
+        """The recorded (location, item, fit map) triples, in file order."""
+        return sorted(self._writes, key=lambda write: write[0])
+
+
+    def _apply(self, fd, size, ranges):
+        for where, item, fit_map in self._items():
+            item.write_to_file(fd, where, fit_map)
+
+
+    def _save_copy(self, patch_name):
+        with open(self._name, 'rb') as source:
+            with open(patch_name, 'wb') as output:
+                position = 0
+                for where, item, fit_map in self._items():
+                    if not len(item):
+                        # Nothing to write; and it may be placed inside
+                        # (or at the start of) an item already written.
+                        continue
+                    _copy_bytes(source, output, where - position)
+                    # The item is written directly to the file descriptor,
+                    # so pending writes need to go first.
+                    output.flush()
+                    item.write_to_file(output.fileno(), where, fit_map)
+                    position = where + len(item)
+                    output.seek(position)
+                    source.seek(position)
+                shutil.copyfileobj(source, output, CHUNK_SIZE)
+
+
+class PlanningTarget(Target):
+    """As `Target`, but only for working out where the patch would go: the
+    file is never read or written (apart from any freespace scanning or
+    reclaiming requested), so the cost doesn't depend on its size. Instead
+    of saving, `plan` reports the fit and the freespace that would be
+    left."""
+
+
+    def _recover(self, patch_name):
+        if os.path.exists(journal_name(patch_name)):
+            raise ValueError(
+                "{} has an interrupted save; patch it normally to recover "
+                "it first.".format(patch_name)
+            )
+
+
+    def _load(self, patch_name):
+        return os.path.getsize(patch_name)
+
+
+    def _report(self, name, where, size):
+        # Nothing is written, only planned.
+        print("Placing: {} in [{}:{}]".format(name, where, where + size))
+
+
+    def _write(self, item, where, fit_map):
+        pass
+
+
+    def plan(self, plan_name):
+        """Write the fit record (as `save` would) and the remaining
+        freespace to the named file, as a JSON object."""
+        with open(plan_name, 'w') as f:
+            json.dump(
+                {'fit': self._fit_record, 'free': self._free.data},
+                f, indent=1, sort_keys=True
+            )